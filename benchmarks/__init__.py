@@ -0,0 +1,10 @@
+"""Scaling benchmarks for add_references.py.
+
+Run from the repository root:
+
+    python -m benchmarks                      # compare against benchmarks/baseline.json
+    python -m benchmarks --update-baseline    # record a new baseline
+
+Everything runs offline with the standard library: figures are generated by
+benchmarks.synthetic instead of being downloaded or rendered by Mermaid.
+"""
@@ -0,0 +1,296 @@
+"""Run the scaling benchmarks: python -m benchmarks [options]
+
+For every (size, density) case a synthetic figure is generated and pushed through
+the same stages as the CLI (SvgSource parsing, then Annotator.annotate_splices).
+The best wall-clock time of --repeat runs is reported per stage, and peak memory is
+measured with tracemalloc in a separate run so that tracing does not skew the timings.
+
+With --baseline (default benchmarks/baseline.json) each case is compared to the
+recorded numbers and the exit status is 1 if total time or peak memory regressed
+by more than --threshold. --update-baseline rewrites the baseline instead.
+Times are compared in units of a fixed pure-Python calibration workload timed
+next to each case, so a faster or slower machine (or one whose speed drifts
+during the run) cancels out. A baseline
+recorded with another Python major.minor version or on another CPU architecture is
+still compared, but only as advice: the exit status is then 0, as it is with
+--advisory.
+
+--backend selects the clearance backend that is timed (default: pure Python).
+--check-parity instead annotates every case with each available clearance backend
+(pure Python and, when NumPy imports, the vectorized one) and exits 1 unless all
+outputs are byte-identical.
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import add_references as ar
+from benchmarks.synthetic import DENSITIES, generate_svg
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+DEFAULT_SIZES = [10, 100, 1000, 10000]
+# Timings below this many seconds are dominated by noise and never flagged
+NOISE_FLOOR = 0.005
+
+def calibrate(repeat=3):
+    """Best time in seconds of a fixed pure-Python workload (grid bucketing, float math, sorting).
+
+    The workload never changes with the code under test, so timings divided by it
+    compare across machines of different speed.
+    """
+    best = math.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        rng = random.Random(0)
+        cells = {}
+        total = 0.0
+        for k in range(100000):
+            x, y = rng.random() * 1000.0, rng.random() * 1000.0
+            cells.setdefault((int(x // 64.0), int(y // 64.0)), []).append(k)
+            total += math.hypot(x, y)
+        sorted(cells.items())
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def run_once(svg_path, annotator, metrics=None):
+    with ar.SvgSource(svg_path) as source:
+        with ar.measure(metrics, 'parse_svg'):
+            source.check_well_formed()
+            source.text()
+        return annotator.annotate_splices(source, metrics=metrics)
+
+def bench_case(n_nodes, density, repeat, tmpdir, seed=0, backend=None):
+    """Benchmark one case with the given clearance backend; returns a result dict."""
+    svg_text = generate_svg(n_nodes, density, seed=seed)
+    svg_path = os.path.join(tmpdir, f'bench_{n_nodes}_{density}.svg')
+    with open(svg_path, 'w', encoding='utf-8') as f:
+        f.write(svg_text)
+    annotator = ar.Annotator(clearance_backend=backend)
+
+    calibration = calibrate()
+    best = None
+    for _ in range(repeat):
+        metrics = ar.PipelineMetrics()
+        run_once(svg_path, annotator, metrics)
+        if best is None:
+            best = dict(metrics.stages)
+        else:
+            for name, seconds in metrics.stages.items():
+                best[name] = min(best.get(name, seconds), seconds)
+    totals = metrics.totals()
+    calibration = min(calibration, calibrate())
+
+    tracemalloc.start()
+    try:
+        run_once(svg_path, annotator)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'nodes': n_nodes,
+        'density': density,
+        'input_bytes': len(svg_text.encode('utf-8')),
+        'stages': best,
+        'total': sum(best.values()),
+        'calibration': calibration,
+        'peak_bytes': peak,
+        'clearance_checks': totals['clearance_checks'],
+        'fallbacks': totals['fallbacks'],
+    }
+
+def check_parity(sizes, densities, seed=0):
+    """Return a list of mismatch messages (empty if every backend agrees)."""
+    backends = sorted(ar.CLEARANCE_BACKENDS)
+    if len(backends) < 2:
+        print("Only the pure-Python clearance backend is available (NumPy not installed); nothing to compare.")
+        return []
+    mismatches = []
+    saved = ar.ArraySpatialIndex.VECTORIZE_MIN_BOXES
+    # Route every query through the arrays, not just the crowded ones
+    ar.ArraySpatialIndex.VECTORIZE_MIN_BOXES = 0
+    try:
+        for n_nodes in sizes:
+            for density in densities:
+                key = f'{n_nodes}/{density}'
+                svg_text = generate_svg(n_nodes, density, seed=seed)
+                outputs = {}
+                for backend in backends:
+                    outputs[backend] = ar.Annotator(clearance_backend=backend).annotate(svg_text)
+                differ = [b for b in backends[1:] if outputs[b] != outputs[backends[0]]]
+                mismatches += [f"{key}: {b} output differs from {backends[0]}" for b in differ]
+                print(f"{key:<14}{'MISMATCH' if differ else 'ok'}")
+    finally:
+        ar.ArraySpatialIndex.VECTORIZE_MIN_BOXES = saved
+    return mismatches
+
+def time_scale(res, base):
+    """Factor that converts the baseline time of a case to this run's machine speed.
+
+    Cases recorded before the calibration workload existed are compared as is.
+    """
+    recorded = base.get('calibration')
+    return res['calibration'] / recorded if recorded else 1.0
+
+def python_minor(version):
+    """'3.11' for '3.11.7'."""
+    return '.'.join(version.split('.')[:2])
+
+def same_machine_kind(baseline):
+    """Whether the baseline was recorded with this Python major.minor on this CPU architecture.
+
+    Calibration absorbs the speed of the machine, but not what a new interpreter
+    or instruction set changes in the relative cost of the code. OS and kernel
+    updates (the rest of platform.platform()) do not matter.
+    """
+    meta = baseline.get('meta', {})
+    return (python_minor(meta.get('python', '')) == python_minor(platform.python_version())
+            and meta.get('machine') == platform.machine())
+
+def compare(results, baseline, threshold):
+    """Return a list of regression messages (empty if none).
+
+    Peak memory is checked per case. Time is checked once, as the geometric mean
+    over the cases of time / scaled baseline time (see time_scale): a single case
+    can be off by a third on a busy machine, a slowdown of the code shows in all.
+    """
+    regressions = []
+    recorded = baseline.get('results', {})
+    log_ratios = []
+    for key, res in results.items():
+        base = recorded.get(key)
+        if base is None:
+            continue
+        if res['total'] > NOISE_FLOOR:
+            log_ratios.append(math.log(res['total'] / (base['total'] * time_scale(res, base))))
+        if res['peak_bytes'] > base['peak_bytes'] * (1 + threshold):
+            regressions.append(f"{key}: peak memory {base['peak_bytes'] / 1e6:.1f} MB -> "
+                               f"{res['peak_bytes'] / 1e6:.1f} MB")
+    if log_ratios:
+        ratio = math.exp(sum(log_ratios) / len(log_ratios))
+        if ratio > 1 + threshold:
+            regressions.append(f"time: {ratio - 1:+.0%} over the scaled baseline "
+                               f"(geometric mean of {len(log_ratios)} cases)")
+    return regressions
+
+def print_table(results, baseline):
+    recorded = baseline.get('results', {}) if baseline else {}
+    stage_names = []
+    for res in results.values():
+        for name in res['stages']:
+            if name not in stage_names:
+                stage_names.append(name)
+    header = f"{'case':<14}" + ''.join(f"{name:>19}" for name in stage_names) + f"{'total ms':>11}{'peak MB':>9}{'vs base':>9}"
+    print(header)
+    for key, res in results.items():
+        row = f"{key:<14}" + ''.join(f"{res['stages'].get(name, 0.0) * 1000:19.2f}" for name in stage_names)
+        row += f"{res['total'] * 1000:11.2f}{res['peak_bytes'] / 1e6:9.2f}"
+        base = recorded.get(key)
+        row += (f"{(res['total'] / (base['total'] * time_scale(res, base)) - 1) * 100:+8.0f}%"
+                if base and base['total'] else f"{'-':>9}")
+        print(row)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks',
+                                     description='Scaling benchmarks for add_references.py')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, metavar='N',
+                        help='Node counts to benchmark (default: 10 100 1000 10000)')
+    parser.add_argument('--densities', nargs='+', choices=sorted(DENSITIES), default=list(DENSITIES),
+                        help='Layout densities to benchmark (default: all)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Timed runs per case; the fastest is kept (default: 3)')
+    parser.add_argument('--seed', type=int, default=0, help='Generator seed (default: 0)')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE,
+                        help='Baseline JSON to compare against or update')
+    parser.add_argument('--update-baseline', action='store_true',
+                        help='Write the results to --baseline instead of comparing')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='Allowed relative slowdown / memory growth before failing (default: 0.25)')
+    parser.add_argument('--json', metavar='FILE', help='Also write the raw results to FILE')
+    parser.add_argument('--advisory', action='store_true',
+                        help='Report regressions without failing (exit status 0)')
+    parser.add_argument('--backend', choices=sorted(ar.CLEARANCE_BACKENDS), default=ar.CLEARANCE_BACKEND,
+                        help=f'Clearance backend to time (default: {ar.CLEARANCE_BACKEND})')
+    parser.add_argument('--check-parity', action='store_true',
+                        help='Check that all clearance backends produce identical output instead of timing')
+    args = parser.parse_args(argv)
+
+    # Placement chatter from the library is not useful here
+    ar.logger.setLevel('WARNING')
+
+    if args.check_parity:
+        mismatches = check_parity(args.sizes, args.densities, seed=args.seed)
+        for msg in mismatches:
+            print(f"  {msg}")
+        return 1 if mismatches else 0
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for n_nodes in args.sizes:
+            for density in args.densities:
+                key = f'{n_nodes}/{density}'
+                print(f"Running {key}...", file=sys.stderr)
+                results[key] = bench_case(n_nodes, density, max(1, args.repeat), tmpdir, seed=args.seed,
+                                          backend=args.backend)
+
+    baseline = None
+    if not args.update_baseline and os.path.exists(args.baseline):
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+
+    print_table(results, baseline)
+
+    payload = {
+        'meta': {
+            'version': ar.__version__,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'machine': platform.machine(),
+            'date': time.strftime('%Y-%m-%d'),
+            'repeat': args.repeat,
+            'seed': args.seed,
+            'clearance_backend': args.backend,
+        },
+        'results': results,
+    }
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(payload, f, indent=2)
+
+    if args.update_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(payload, f, indent=2)
+            f.write('\n')
+        print(f"Baseline written to {args.baseline}")
+        return 0
+
+    if baseline is None:
+        print(f"No baseline at {args.baseline}; run with --update-baseline to record one.")
+        return 0
+    regressions = compare(results, baseline, args.threshold)
+    if regressions:
+        print(f"\nRegressions (threshold {args.threshold:.0%}):")
+        for msg in regressions:
+            print(f"  {msg}")
+        if args.advisory:
+            print("Advisory only (--advisory).")
+            return 0
+        if not same_machine_kind(baseline):
+            meta = baseline.get('meta', {})
+            print(f"Advisory only: the baseline was recorded on {meta.get('machine') or 'an unknown architecture'} "
+                  f"with Python {meta.get('python')}. Run with --update-baseline on this kind of machine "
+                  "for a gating comparison.")
+            return 0
+        return 1
+    print(f"\nNo regressions beyond {args.threshold:.0%} of baseline.")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,115 @@
+"""Generator for Mermaid-shaped flowchart SVGs of arbitrary size.
+
+The output mimics what Mermaid exports (see euclid.svg): each node is a
+<g data-et="node"> group positioned with a translate transform and drawn as a
+rect, circle, diamond or parallelogram, followed by a label group. Vertical edges
+join consecutive nodes of a column, and edges leaving a diamond carry a Yes/No
+edge label.
+"""
+import random
+
+# Spacing multipliers applied to the default column width and row height
+DENSITIES = {
+    'sparse': 1.6,
+    'normal': 1.0,
+    'dense': 0.6,
+}
+
+SHAPES = ('rect', 'circle', 'diamond', 'parallelogram')
+
+_LABEL = (
+    '<g class="label" style="" transform="translate({lx}, -10.5)"><rect/>'
+    '<foreignObject width="{lw}" height="21"><div style="display: table-cell; white-space: normal; '
+    'line-height: 1.5; max-width: 200px; text-align: center;" xmlns="http://www.w3.org/1999/xhtml">'
+    '<span class="nodeLabel"><p>{text}</p></span></div></foreignObject></g>'
+)
+
+def _shape_svg(shape, w, h):
+    if shape == 'rect':
+        return (f'<rect class="basic label-container" style="" x="{-w / 2}" y="{-h / 2}" '
+                f'width="{w}" height="{h}" stroke="url(#gradient)"/>')
+    if shape == 'circle':
+        return f'<circle class="basic label-container" style="" r="{h / 2}" cx="0" cy="0"/>'
+    if shape == 'diamond':
+        s = h
+        return (f'<polygon points="{s / 2},0 {s},{-s / 2} {s / 2},{-s} 0,{-s / 2}" '
+                f'class="label-container" transform="translate({-s / 2},{s / 2})"/>')
+    slant = h / 2
+    return (f'<polygon points="{-slant},0 {w - slant},0 {w},{-h} 0,{-h}" '
+            f'class="label-container" transform="translate({-w / 2 + slant / 2},{h / 2})"/>')
+
+def generate_svg(n_nodes, density='normal', seed=0):
+    """Return SVG text for a synthetic flowchart with n_nodes nodes.
+
+    density is one of DENSITIES; the same (n_nodes, density, seed) always yields
+    the same document.
+    """
+    rnd = random.Random(seed)
+    factor = DENSITIES[density]
+    col_w = 260.0 * factor
+    row_h = 110.0 * factor
+    cols = max(1, int(round((n_nodes / 4.0) ** 0.5)))
+    rows = (n_nodes + cols - 1) // cols
+    width = cols * col_w + 100
+    height = rows * row_h + 100
+
+    nodes = []
+    for i in range(n_nodes):
+        col, row = i % cols, i // cols
+        shape = SHAPES[rnd.randrange(len(SHAPES))]
+        w = rnd.choice((70.0, 110.0, 150.0, 190.0))
+        h = 60.0 if shape == 'diamond' else 45.0
+        cx = 50 + col * col_w + col_w / 2 + rnd.uniform(-0.15, 0.15) * col_w
+        cy = 50 + row * row_h + row_h / 2
+        nodes.append((f'id{100 + i}', shape, w, h, round(cx, 4), round(cy, 4)))
+
+    edges = []
+    edge_labels = []
+    for i, (nid, shape, w, h, cx, cy) in enumerate(nodes):
+        j = i + cols
+        if j >= n_nodes:
+            continue
+        oid, _, _, oh, ox, oy = nodes[j]
+        y0, y1 = cy + h / 2, oy - oh / 2
+        my = (y0 + y1) / 2
+        edge_id = f'L_{nid}_{oid}_0'
+        edges.append(
+            f'<path d="M{cx},{y0}C{cx},{y0},{cx},{my},{(cx + ox) / 2},{my}C{ox},{my},{ox},{y1},{ox},{y1}" '
+            f'id="{edge_id}" class="edge-thickness-normal edge-pattern-solid flowchart-link" '
+            f'data-edge="true" data-et="edge" data-id="{edge_id}" '
+            f'marker-end="url(#export-svg_flowchart-v2-pointEnd-margin)"/>'
+        )
+        text = 'Yes' if shape == 'diamond' else ''
+        lw = 24.0 if text else 0.0
+        pos = f' transform="translate({(cx + ox) / 2}, {my})"' if text else ''
+        edge_labels.append(
+            f'<g class="edgeLabel"{pos}><g class="label" data-id="{edge_id}" transform="translate({-lw / 2}, -10.5)">'
+            f'<foreignObject width="{lw}" height="{21 if text else 0}"><div xmlns="http://www.w3.org/1999/xhtml" '
+            f'class="labelBkg"><span class="edgeLabel">{f"<p>{text}</p>" if text else ""}</span></div>'
+            f'</foreignObject></g></g>'
+        )
+
+    out = [
+        f'<svg id="export-svg" width="100%" xmlns="http://www.w3.org/2000/svg" class="flowchart" '
+        f'style="max-width: {width}px;" viewBox="0 0 {width} {height}" role="graphics-document document" '
+        f'aria-roledescription="flowchart-v2">',
+        '<style>#export-svg{font-family:"trebuchet ms",verdana,arial,sans-serif;font-size:14px;}'
+        '#export-svg .node rect,#export-svg .node polygon{fill:#ffffff;stroke:#28253D;stroke-width:2px;}'
+        '#export-svg .flowchart-link{stroke:#000000;fill:none;}</style>',
+        '<g><g class="root"><g class="clusters"/><g class="edgePaths">',
+    ]
+    out.extend(edges)
+    out.append('</g><g class="edgeLabels">')
+    out.extend(edge_labels)
+    out.append('</g><g class="nodes">')
+    for i, (nid, shape, w, h, cx, cy) in enumerate(nodes):
+        lw = min(w - 16, 200.0)
+        out.append(
+            f'<g class="node default" id="flowchart-{nid}-{i}" data-id="{nid}" data-node="true" '
+            f'data-et="node" data-look="neo" transform="translate({cx}, {cy})">'
+            + _shape_svg(shape, w, h)
+            + _LABEL.format(lx=-lw / 2, lw=lw, text=f'Step {i}')
+            + '</g>'
+        )
+    out.append('</g></g></g></svg>')
+    return ''.join(out)
@@ -0,0 +1,90 @@
+"""Regression tests for the annotation pipeline, run with python -m pytest or python -m unittest."""
+
+import os
+import re
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import add_references as ar  # noqa: E402
+
+USER_GROUP = '<g id="annotations"><text>MINE</text></g>'
+
+
+def read_figure(name='euclid.svg'):
+    with open(os.path.join(ROOT, name), encoding='utf-8') as f:
+        return f.read()
+
+
+def with_user_group(svg):
+    """svg with a user group that shares the annotation group's id, first inside <svg>."""
+    return re.sub(r'(<svg\b[^>]*>)', lambda m: m.group(1) + USER_GROUP, svg, count=1)
+
+
+class StripAnnotationsTest(unittest.TestCase):
+    def test_user_group_with_same_id_is_kept(self):
+        svg = with_user_group(read_figure())
+        once = ar.Annotator().annotate(svg).svg
+        self.assertIn(USER_GROUP, once)
+        twice = ar.Annotator().annotate(once).svg
+        self.assertEqual(twice.count(USER_GROUP), 1)
+        self.assertEqual(twice, once)
+
+    def test_unmarked_groups_are_stripped_on_request(self):
+        svg = with_user_group(read_figure())
+        self.assertIn(USER_GROUP, ar.remove_existing_annotations(svg))
+        self.assertNotIn(USER_GROUP, ar.remove_existing_annotations(svg, unmarked=True))
+        output = ar.OutputFormat(strip_unmarked=True)
+        self.assertNotIn('MINE', ar.Annotator(output=output).annotate(svg).svg)
+
+
+class WriteOutputTest(unittest.TestCase):
+    class FailingEdits:
+        def write(self, f):
+            f.write(b'<svg')
+            raise RuntimeError('disk full')
+
+    def test_failed_write_keeps_target_and_removes_temporary_file(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            target = os.path.join(tmp, 'out.svg')
+            with open(target, 'w', encoding='utf-8') as f:
+                f.write('previous')
+            with self.assertRaises(RuntimeError):
+                ar.write_output(self.FailingEdits(), target)
+            self.assertEqual(os.listdir(tmp), ['out.svg'])
+            with open(target, encoding='utf-8') as f:
+                self.assertEqual(f.read(), 'previous')
+
+    def test_write_replaces_target(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            target = os.path.join(tmp, 'out.svg')
+            ar.write_output(ar.SpliceEdits('<svg/>'), target)
+            self.assertEqual(os.listdir(tmp), ['out.svg'])
+            with open(target, encoding='utf-8') as f:
+                self.assertEqual(f.read(), '<svg/>')
+
+
+class StdioRequestTest(unittest.TestCase):
+    def test_inline_svg_matches_file_request(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            from_file = os.path.join(tmp, 'file.svg')
+            inline = os.path.join(tmp, 'inline.svg')
+            ar.handle_stdio_request({'input': os.path.join(ROOT, 'euclid.svg'), 'output': from_file}, {})
+            response = ar.handle_stdio_request({'svg': read_figure(), 'output': inline}, {})
+            self.assertTrue(response['ok'], response['error'])
+            with open(from_file, encoding='utf-8') as a, open(inline, encoding='utf-8') as b:
+                expected = a.read()
+                self.assertEqual(b.read(), expected)
+            self.assertEqual(ar.handle_stdio_request({'svg': read_figure()}, {})['svg'], expected)
+
+    def test_malformed_inline_svg_is_reported(self):
+        response = ar.handle_stdio_request({'svg': '<svg><g>'}, {})
+        self.assertFalse(response['ok'])
+        self.assertTrue(response['error'].startswith('ParseError'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,33 @@
+"""The benchmark gate: which baselines are compared as a gate rather than as advice."""
+
+import os
+import platform
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.__main__ import same_machine_kind  # noqa: E402
+
+
+def baseline(**meta):
+    here = {'python': platform.python_version(), 'platform': platform.platform(), 'machine': platform.machine()}
+    return {'meta': dict(here, **meta), 'results': {}}
+
+
+class SameMachineKindTest(unittest.TestCase):
+    def test_os_and_patch_updates_still_gate(self):
+        major, minor = platform.python_version_tuple()[:2]
+        self.assertTrue(same_machine_kind(baseline(platform='Linux-0.0.1-other-kernel')))
+        self.assertTrue(same_machine_kind(baseline(python=f'{major}.{minor}.999')))
+
+    def test_other_python_or_architecture_is_advisory(self):
+        major, minor = platform.python_version_tuple()[:2]
+        self.assertFalse(same_machine_kind(baseline(python=f'{major}.{int(minor) + 1}.0')))
+        self.assertFalse(same_machine_kind(baseline(machine='not-' + platform.machine())))
+        self.assertFalse(same_machine_kind({'meta': {}}))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+"""The clearance backends must place every label identically."""
+
+import importlib.util
+import os
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import add_references as ar  # noqa: E402
+from benchmarks.synthetic import DENSITIES, generate_svg  # noqa: E402
+
+
+@unittest.skipIf(importlib.util.find_spec('numpy') is None, 'NumPy is not installed')
+class ClearanceBackendParityTest(unittest.TestCase):
+    def setUp(self):
+        # Route every query through the arrays, not just the crowded ones
+        saved = ar.ArraySpatialIndex.VECTORIZE_MIN_BOXES
+        ar.ArraySpatialIndex.VECTORIZE_MIN_BOXES = 0
+        self.addCleanup(setattr, ar.ArraySpatialIndex, 'VECTORIZE_MIN_BOXES', saved)
+
+    def test_synthetic_figures_are_byte_identical(self):
+        for n_nodes in (100, 400):
+            for density in DENSITIES:
+                with self.subTest(nodes=n_nodes, density=density):
+                    svg = generate_svg(n_nodes, density, seed=0)
+                    python = ar.Annotator(clearance_backend='python').annotate(svg)
+                    numpy = ar.Annotator(clearance_backend='numpy').annotate(svg)
+                    self.assertTrue(python.nodes)
+                    self.assertEqual(numpy.svg, python.svg)
+                    self.assertEqual(numpy.curve_logs, python.curve_logs)
+
+    def test_auto_prefers_numpy(self):
+        self.assertEqual(ar.resolve_clearance_backend('auto'), 'numpy')
+        self.assertIsInstance(ar.obstacle_index(backend='numpy'), ar.ArraySpatialIndex)
+
+
+class ClearanceBackendChoiceTest(unittest.TestCase):
+    def test_unknown_backend_is_rejected(self):
+        with self.assertRaises(ValueError):
+            ar.Annotator(clearance_backend='fortran')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+"""Options that change how a figure is annotated, but must not change the output."""
+
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import add_references as ar  # noqa: E402
+from benchmarks.synthetic import DENSITIES, generate_svg  # noqa: E402
+
+
+class ParallelPlacementTest(unittest.TestCase):
+    def setUp(self):
+        # Split figures far below the production threshold, so the test stays small
+        saved = ar.PARALLEL_PLACEMENT_MIN_NODES
+        ar.PARALLEL_PLACEMENT_MIN_NODES = 0
+        self.addCleanup(setattr, ar, 'PARALLEL_PLACEMENT_MIN_NODES', saved)
+
+    def test_jobs_match_sequential_placement(self):
+        for density in DENSITIES:
+            with self.subTest(density=density):
+                svg = generate_svg(300, density, seed=0)
+                nodes, _ = ar.extract_geometry(svg)
+                ovs = [{} for _ in nodes]
+                flow_mid = sum(n['cx'] for n in nodes) / len(nodes)
+                # The figure really is split, so the worker processes are exercised
+                self.assertIsNotNone(ar.place_labels_parallel(nodes, ovs, flow_mid, jobs=2))
+                self.assertEqual(ar.Annotator(jobs=2).annotate(svg), ar.Annotator().annotate(svg))
+
+
+class BandStreamingTest(unittest.TestCase):
+    def test_band_heights_match_normal_placement(self):
+        for density in DENSITIES:
+            svg = generate_svg(300, density, seed=0)
+            expected = ar.Annotator().annotate(svg)
+            for band_height in (100, ar.STREAM_BAND_HEIGHT):
+                with self.subTest(density=density, band_height=band_height):
+                    self.assertEqual(ar.Annotator(band_height=band_height).annotate(svg), expected)
+
+    def test_compact_band_output_matches(self):
+        svg = generate_svg(300, 'dense', seed=0)
+        output = ar.OutputFormat(compact=True)
+        self.assertEqual(ar.Annotator(output=output, band_height=100).annotate(svg),
+                         ar.Annotator(output=output).annotate(svg))
+
+
+class ReannotationTest(unittest.TestCase):
+    def setUp(self):
+        with open(os.path.join(ROOT, 'euclid.svg'), encoding='utf-8') as f:
+            self.svg = f.read()
+
+    def test_annotating_twice_changes_nothing(self):
+        for output in (None, ar.OutputFormat(compact=True), ar.OutputFormat(compact=True, minify=True)):
+            with self.subTest(output=output):
+                annotator = ar.Annotator(output=output)
+                once = annotator.annotate(self.svg).svg
+                self.assertEqual(annotator.annotate(once).svg, once)
+
+    def test_plain_run_restores_verbose_markup(self):
+        compact = ar.Annotator(output=ar.OutputFormat(compact=True)).annotate(self.svg).svg
+        self.assertEqual(ar.Annotator().annotate(compact).svg, ar.Annotator().annotate(self.svg).svg)
+
+    def test_removing_annotations_restores_the_input(self):
+        annotated = ar.Annotator().annotate(self.svg).svg
+        self.assertEqual(ar.remove_existing_annotations(annotated), self.svg)
+
+
+class BatchAndCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.inputs = []
+        for name, svg in (('euclid', None), ('synthetic', generate_svg(100, 'normal', seed=0))):
+            path = os.path.join(self.tmp, f'{name}.svg')
+            if svg is None:
+                shutil.copyfile(os.path.join(ROOT, 'euclid.svg'), path)
+            else:
+                with open(path, 'w', encoding='utf-8') as f:
+                    f.write(svg)
+            self.inputs.append(path)
+
+    def expected(self, path):
+        with open(path, encoding='utf-8') as f:
+            return ar.Annotator().annotate(f.read()).svg
+
+    def outputs(self, results):
+        texts = []
+        for r in results:
+            self.assertTrue(r['ok'], r['error'])
+            with open(r['output'], encoding='utf-8') as f:
+                texts.append(f.read())
+        return texts
+
+    def run_batch(self, output_dir, **kwargs):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return ar.run_batch(self.inputs, {}, output_dir=os.path.join(self.tmp, output_dir), **kwargs)
+
+    def test_batch_matches_single_figures(self):
+        expected = [self.expected(p) for p in self.inputs]
+        for jobs in (1, 2):
+            with self.subTest(jobs=jobs):
+                self.assertEqual(self.outputs(self.run_batch(f'out{jobs}', jobs=jobs)), expected)
+
+    def test_cache_hit_matches_miss(self):
+        cache = ar.ResultCache(os.path.join(self.tmp, 'cache'))
+        missed = self.run_batch('miss', jobs=1, cache=cache)
+        hit = self.run_batch('hit', jobs=1, cache=cache)
+        self.assertEqual([r['cache'] for r in missed], ['miss', 'miss'])
+        self.assertEqual([r['cache'] for r in hit], ['hit', 'hit'])
+        self.assertEqual(self.outputs(hit), self.outputs(missed))
+        self.assertEqual(self.outputs(hit), [self.expected(p) for p in self.inputs])
+
+
+if __name__ == '__main__':
+    unittest.main()